@@ -1,31 +1,70 @@
 # claude_client.py - клиент для взаимодействия с Claude API
-import json
 import aiohttp
-from typing import List, Dict, Any, Optional
+from multidict import CIMultiDict, CIMultiDictProxy
+from typing import AsyncIterator, List, Dict, Any, Optional
+
+from app.utils.serialization import dumps, loads
+
+
+class ClaudeAPIError(Exception):
+    """Ошибка, возвращенная Claude API."""
 
 
 class ClaudeClient:
     """Клиент для работы с Claude API."""
 
+    # Длительность потокового ответа не ограничиваем: обрываем только при
+    # долгой установке соединения или если поток замолчал
+    _STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+
     def __init__(self, api_key: str, base_url: str = "https://api.anthropic.com/v1/messages"):
         self.api_key = api_key
         self.base_url = base_url
-        self.headers = {
+        # Заголовки собираются один раз в том виде, в котором их хранит сессия aiohttp
+        self.headers = CIMultiDictProxy(CIMultiDict({
             "Content-Type": "application/json",
             "X-API-Key": api_key,
             "anthropic-version": "2023-06-01"
-        }
-
-    async def send_message(
-        self,
-        messages: List[Dict[str, str]],
-        model: str = "claude-3-7-sonnet-20250219",
-        temperature: float = 0.7,
-        max_tokens: int = 4000,
-        system: Optional[str] = None
+        }))
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Получение общей HTTP-сессии (создается лениво в цикле событий бота)."""
+        if self._session is None or self._session.closed:
+            # Одна сессия на всех пользователей: keep-alive соединения
+            # к API переиспользуются, DNS кэшируется.
+            # Все запросы идут на один хост, поэтому общий лимит равен лимиту на хост
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=50,
+                    limit_per_host=50,
+                    ttl_dns_cache=600,
+                    enable_cleanup_closed=True,
+                    keepalive_timeout=120
+                ),
+                # Ограничиваем хвостовые задержки: долгая установка соединения
+                # или зависший ответ не держат обработчик бесконечно
+                timeout=aiohttp.ClientTimeout(total=120, sock_connect=10),
+                trust_env=True
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Закрытие HTTP-сессии."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def _build_payload(
+        messages: List[Dict[str, Any]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        system: Optional[str]
     ) -> Dict[str, Any]:
-        """Отправка запроса к Claude API."""
-
+        """Формирование тела запроса к Claude API."""
         payload = {
             "model": model,
             "messages": messages,
@@ -36,38 +75,153 @@ class ClaudeClient:
         if system:
             payload["system"] = system
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.base_url,
-                headers=self.headers,
-                json=payload
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"API error: {response.status}, {error_text}")
+        return payload
 
-                return await response.json()
+    async def send_message(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str = "claude-3-7-sonnet-20250219",
+        temperature: float = 0.7,
+        max_tokens: int = 4000,
+        system: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Отправка запроса к Claude API."""
+        payload = self._build_payload(messages, model, temperature, max_tokens, system)
+
+        session = await self._get_session()
+        # Заголовки уже заданы на уровне сессии
+        async with session.post(self.base_url, data=dumps(payload)) as response:
+            # Тело читаем один раз как bytes и разбираем без промежуточной строки
+            raw = await response.read()
+            if response.status != 200:
+                raise ClaudeAPIError(f"API error: {response.status}, {raw[:500]!r}")
+
+            try:
+                return loads(raw)
+            except ValueError as e:
+                raise ClaudeAPIError(f"API error: invalid JSON response, {raw[:500]!r}") from e
+
+    async def send_message_stream(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str = "claude-3-7-sonnet-20250219",
+        temperature: float = 0.7,
+        max_tokens: int = 4000,
+        system: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Потоковый запрос к Claude API: фрагменты текста ответа по мере генерации."""
+        payload = self._build_payload(messages, model, temperature, max_tokens, system)
+        payload["stream"] = True
+
+        session = await self._get_session()
+        async with session.post(
+            self.base_url, data=dumps(payload), timeout=self._STREAM_TIMEOUT
+        ) as response:
+            if response.status != 200:
+                raw = await response.read()
+                raise ClaudeAPIError(f"API error: {response.status}, {raw[:500]!r}")
+
+            # Ответ приходит как SSE: нас интересуют только строки "data: {...}"
+            async for line in response.content:
+                if not line.startswith(b"data:"):
+                    continue
+
+                try:
+                    event = loads(line[5:])
+                except ValueError as e:
+                    raise ClaudeAPIError(f"API error: invalid stream event, {line[:500]!r}") from e
+                event_type = event.get("type")
+                if event_type == "content_block_delta":
+                    delta = event["delta"]
+                    if delta.get("type") == "text_delta":
+                        yield delta["text"]
+                elif event_type == "error":
+                    raise ClaudeAPIError(f"API error: {event['error']}")
+                elif event_type == "message_stop":
+                    return
+
+            # Поток оборвался до message_stop - ответ неполный
+            raise ClaudeAPIError("API error: stream ended before message_stop")
 
 
 # database.py - работа с базой данных
 import sqlite3
-from typing import Dict, Any, List, Optional
-import json
-import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
 
 class Database:
     """Класс для работы с базой данных SQLite."""
 
+    # SQL-запросы заданы константами: sqlite3 кэширует подготовленные выражения
+    # по тексту запроса, поэтому повторные вызовы обходятся без разбора SQL
+    _SQL_USER_EXISTS = "SELECT 1 FROM users WHERE user_id = ?"
+    _SQL_REGISTER_USER = (
+        "INSERT OR IGNORE INTO users (user_id, username, model, temperature, max_tokens) "
+        "VALUES (?, ?, ?, ?, ?)"
+    )
+    _SQL_GET_SETTINGS = "SELECT model, temperature, max_tokens, settings FROM users WHERE user_id = ?"
+
+    # Основные настройки хранятся в отдельных колонках, в JSON (settings) - только прочие
+    _TYPED_SETTINGS = {"model": "TEXT", "temperature": "REAL", "max_tokens": "INTEGER"}
+    _SQL_SET_TYPED_SETTING = {
+        column: f"UPDATE users SET {column} = ? WHERE user_id = ?" for column in _TYPED_SETTINGS
+    }
+    _SQL_MIGRATE_SETTINGS = (
+        "UPDATE users SET "
+        "model = json_extract(settings, '$.model'), "
+        "temperature = json_extract(settings, '$.temperature'), "
+        "max_tokens = json_extract(settings, '$.max_tokens'), "
+        "settings = json_remove(settings, '$.model', '$.temperature', '$.max_tokens') "
+        "WHERE settings IS NOT NULL"
+    )
+    # Точечное обновление одного ключа прочих настроек средствами JSON1, без разбора в Python
+    _SQL_SET_SETTING = (
+        "UPDATE users SET settings = json_set(COALESCE(settings, '{}'), '$.' || ?, ?) "
+        "WHERE user_id = ?"
+    )
+    _SQL_SET_SETTING_JSON = (
+        "UPDATE users SET settings = json_set(COALESCE(settings, '{}'), '$.' || ?, json(?)) "
+        "WHERE user_id = ?"
+    )
+    _SQL_LOG_CONVERSATION = (
+        "INSERT INTO conversations (user_id, user_message, bot_response) VALUES (?, ?, ?)"
+    )
+    # updated_at заполняется значением по умолчанию (REPLACE вставляет строку заново)
+    _SQL_SAVE_SESSION = "INSERT OR REPLACE INTO sessions (user_id, history) VALUES (?, ?)"
+
+    # Максимальное число пользователей в кэше настроек
+    _settings_cache_size = 10_000
+
     def __init__(self, db_name: str = "claude_bot.db"):
         self.db_name = db_name
+        # LRU-кэш настроек: настройки меняются редко, а читаются на каждое сообщение
+        self._settings_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+        # Одно соединение на всё приложение: без открытия файла на каждый запрос.
+        # Соединение используется из разных потоков, поэтому доступ под блокировкой
+        self.conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=128
+        )
+        self.lock = threading.RLock()
+
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA mmap_size=268435456")
+
+        # Схема создается идемпотентно, поэтому применяется и к существующей базе
         self._initialize_db()
 
     def _initialize_db(self):
         """Инициализация базы данных."""
-        if not os.path.exists(self.db_name):
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
+        with self.lock:
+            cursor = self.conn.cursor()
 
             # Таблица пользователей
             cursor.execute('''
@@ -75,10 +229,21 @@ class Database:
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                settings TEXT DEFAULT '{}'
+                settings TEXT DEFAULT '{}',
+                model TEXT,
+                temperature REAL,
+                max_tokens INTEGER
             )
             ''')
 
+            # Миграция старой схемы: переносим основные настройки из JSON в колонки
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+            if "model" not in columns:
+                with self.transaction() as conn:
+                    for column, column_type in self._TYPED_SETTINGS.items():
+                        conn.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+                    conn.execute(self._SQL_MIGRATE_SETTINGS)
+
             # Таблица диалогов
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS conversations (
@@ -91,151 +256,353 @@ class Database:
             )
             ''')
 
+            # Индекс для выборок истории пользователя по времени
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conv_user_ts
+            ON conversations (user_id, timestamp DESC)
+            ''')
+
             # Таблица сессий
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS sessions (
                 user_id INTEGER PRIMARY KEY,
-                history TEXT,
+                history BLOB,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
             ''')
 
-            conn.commit()
-            conn.close()
+            # Время изменения сессии при UPDATE проставляет сама база
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_sessions_updated_at
+            AFTER UPDATE OF history ON sessions
+            BEGIN
+                UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE user_id = NEW.user_id;
+            END
+            ''')
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Выполнение нескольких запросов в одной транзакции (один commit)."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def close(self) -> None:
+        """Закрытие соединения с базой данных."""
+        with self.lock:
+            self.conn.close()
+
+    def _cache_settings(self, user_id: int, settings: Dict[str, Any]) -> None:
+        """Запись настроек в LRU-кэш."""
+        with self.lock:
+            self._settings_cache[user_id] = settings
+            self._settings_cache.move_to_end(user_id)
+            if len(self._settings_cache) > self._settings_cache_size:
+                self._settings_cache.popitem(last=False)
 
     def user_exists(self, user_id: int) -> bool:
         """Проверка существования пользователя."""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone() is not None
-
-        conn.close()
-        return result
+        with self.lock:
+            cursor = self.conn.execute(self._SQL_USER_EXISTS, (user_id,))
+            return cursor.fetchone() is not None
 
     def register_user(self, user_id: int, username: str) -> None:
-        """Регистрация нового пользователя."""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        default_settings = json.dumps({
+        """Регистрация пользователя, если он еще не зарегистрирован."""
+        settings = {
             "model": "claude-3-7-sonnet-20250219",
             "temperature": 0.7,
             "max_tokens": 4000
-        })
-
-        cursor.execute(
-            "INSERT INTO users (user_id, username, settings) VALUES (?, ?, ?)",
-            (user_id, username, default_settings)
-        )
+        }
 
-        conn.commit()
-        conn.close()
+        with self.lock:
+            # Повторная регистрация ничего не меняет, отдельная проверка не нужна
+            cursor = self.conn.execute(
+                self._SQL_REGISTER_USER,
+                (user_id, username, settings["model"], settings["temperature"], settings["max_tokens"])
+            )
+            if cursor.rowcount:
+                self._cache_settings(user_id, settings)
 
     def get_user_settings(self, user_id: int) -> Dict[str, Any]:
         """Получение настроек пользователя."""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT settings FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-
-        conn.close()
-
-        if result:
-            return json.loads(result[0])
-
-        return {}
+        with self.lock:
+            settings = self._settings_cache.get(user_id)
+            if settings is not None:
+                self._settings_cache.move_to_end(user_id)
+                return dict(settings)
+
+            cursor = self.conn.execute(self._SQL_GET_SETTINGS, (user_id,))
+            result = cursor.fetchone()
+
+            settings = {}
+            if result:
+                model, temperature, max_tokens, extra = result
+                # JSON разбираем, только если в нем есть прочие настройки
+                if extra and extra != "{}":
+                    settings.update(loads(extra))
+                for key, value in (
+                    ("model", model), ("temperature", temperature), ("max_tokens", max_tokens)
+                ):
+                    if value is not None:
+                        settings[key] = value
+            self._cache_settings(user_id, settings)
+
+        return dict(settings)
 
     def update_user_setting(self, user_id: int, key: str, value: Any) -> None:
         """Обновление настройки пользователя."""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        settings = self.get_user_settings(user_id)
-        settings[key] = value
-
-        cursor.execute(
-            "UPDATE users SET settings = ? WHERE user_id = ?",
-            (json.dumps(settings), user_id)
-        )
-
-        conn.commit()
-        conn.close()
+        if key in self._SQL_SET_TYPED_SETTING:
+            stmt = self._SQL_SET_TYPED_SETTING[key]
+            params = (value, user_id)
+        elif isinstance(value, (bool, dict, list)) or value is None:
+            # Не скалярные для SQLite значения передаем как JSON-текст
+            stmt = self._SQL_SET_SETTING_JSON
+            params = (key, dumps(value).decode(), user_id)
+        else:
+            stmt = self._SQL_SET_SETTING
+            params = (key, value, user_id)
+
+        with self.lock:
+            self.conn.execute(stmt, params)
+            self._settings_cache.pop(user_id, None)
 
     def log_conversation(self, user_id: int, user_message: str, bot_response: str) -> None:
         """Логирование диалога."""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO conversations (user_id, user_message, bot_response) VALUES (?, ?, ?)",
-            (user_id, user_message, bot_response)
-        )
+        with self.lock:
+            self.conn.execute(self._SQL_LOG_CONVERSATION, (user_id, user_message, bot_response))
 
-        conn.commit()
-        conn.close()
+    def persist_turns(
+        self,
+        sessions: List[Tuple[int, memoryview]],
+        logs: List[Tuple[int, str, str]]
+    ) -> None:
+        """Пакетное сохранение историй и лога диалогов одной транзакцией."""
+        with self.transaction() as conn:
+            if sessions:
+                conn.executemany(self._SQL_SAVE_SESSION, sessions)
+            if logs:
+                conn.executemany(self._SQL_LOG_CONVERSATION, logs)
 
 
 # session_manager.py - управление сессиями диалога
-import json
+import asyncio
+import logging
 from typing import List, Dict, Any
-from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def _approx_tokens(message: Dict[str, str]) -> int:
+    """Грубая оценка числа токенов в сообщении (~4 символа на токен)."""
+    return (len(message["content"]) + 3) // 4
 
 
 class SessionManager:
     """Менеджер сессий для управления историей диалогов."""
 
-    def __init__(self, db: Database):
+    _SQL_GET_SESSION = "SELECT history FROM sessions WHERE user_id = ?"
+
+    # При превышении бюджета история урезается до этой доли от max_tokens_history
+    _TRIM_LOW_WATER = 0.6
+
+    def __init__(
+        self,
+        db: Database,
+        flush_interval: float = 5.0,
+        max_cached_sessions: int = 10_000,
+        max_tokens_history: int = 6000
+    ):
         self.db = db
+        # Используем общее соединение базы вместо открытия нового
+        self.conn = db.conn
+        self.flush_interval = flush_interval
+        self.max_cached_sessions = max_cached_sessions
+        self.max_tokens_history = max_tokens_history
+
+        # Живые истории держим в памяти, в SQLite сбрасываем в фоне (write-back)
+        self._mem: "OrderedDict[int, List[Dict[str, str]]]" = OrderedDict()
+        self._dirty: set = set()
+        # Вытесненные из памяти, но еще не записанные сессии (пишет flush)
+        self._evicted: Dict[int, List[Dict[str, str]]] = {}
+        self._pending_logs: List[Tuple[int, str, str]] = []
+        self._mem_lock = threading.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    def start(self) -> None:
+        """Запуск фонового сброса сессий (вызывается из цикла событий)."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flusher())
+
+    async def close(self) -> None:
+        """Остановка фонового сброса и запись оставшихся изменений."""
+        if self._flush_task is not None:
+            # Задачу не отменяем: отмена не останавливает сброс, уже идущий в потоке,
+            # и база могла бы закрыться посреди записи. Дожидаемся его завершения
+            self._stopping.set()
+            await self._flush_task
+            self._flush_task = None
+        await asyncio.to_thread(self.flush)
+
+    async def _flusher(self) -> None:
+        """Периодический сброс измененных сессий в базу до вызова close()."""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении сессий: {e}")
+
+    def flush(self) -> None:
+        """Запись измененных сессий и накопленного лога в базу."""
+        with self._mem_lock:
+            dirty = [(user_id, self._mem[user_id]) for user_id in self._dirty]
+            dirty.extend(self._evicted.items())
+            logs = self._pending_logs
+            self._dirty = set()
+            self._evicted = {}
+            self._pending_logs = []
+
+        if not dirty and not logs:
+            return
+
+        # Истории в памяти не изменяются на месте, поэтому сериализуем вне блокировки
+        sessions = [(user_id, self._serialize(history)) for user_id, history in dirty]
+        try:
+            self.db.persist_turns(sessions, logs)
+        except Exception:
+            # Возвращаем несохраненное, чтобы записать при следующем сбросе.
+            # Если сессия за это время снова попала в память, там ее актуальная версия
+            with self._mem_lock:
+                for user_id, history in dirty:
+                    if user_id in self._mem:
+                        self._dirty.add(user_id)
+                    else:
+                        self._evicted.setdefault(user_id, history)
+                self._pending_logs[:0] = logs
+            raise
+
+    @staticmethod
+    def _serialize(history: List[Dict[str, str]]) -> memoryview:
+        """Сериализация истории для хранения в BLOB-колонке без перекодирования в текст."""
+        return sqlite3.Binary(dumps(history))
+
+    def _store(self, user_id: int, history: List[Dict[str, str]]) -> None:
+        """Запись истории в память (вызывается под self._mem_lock)."""
+        self._mem[user_id] = history
+        self._mem.move_to_end(user_id)
+        # Новая версия заменяет вытесненную, но еще не записанную
+        self._evicted.pop(user_id, None)
+        while len(self._mem) > self.max_cached_sessions:
+            evicted_id, evicted = self._mem.popitem(last=False)
+            if evicted_id in self._dirty:
+                # Несохраненную сессию не теряем: ее запишет следующий flush
+                self._dirty.discard(evicted_id)
+                self._evicted[evicted_id] = evicted
 
     def get_session(self, user_id: int) -> List[Dict[str, str]]:
         """Получение истории диалога для пользователя."""
-        conn = sqlite3.connect(self.db.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT history FROM sessions WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-
-        conn.close()
-
-        if result:
-            return json.loads(result[0])
-
-        return []
+        with self._mem_lock:
+            history = self._mem.get(user_id)
+            if history is not None:
+                self._mem.move_to_end(user_id)
+                # Возвращаем копию: вызывающий код дополняет список до ответа API
+                return list(history)
+
+            history = self._evicted.get(user_id)
+            if history is not None:
+                # Вытесненная сессия еще не записана - возвращаем ее в память как измененную
+                self._dirty.add(user_id)
+                self._store(user_id, history)
+                return list(history)
+
+        # Первое обращение после запуска - загружаем из базы. Чтение идет без
+        # блокировки памяти, чтобы не задерживать остальных пользователей
+        with self.db.lock:
+            cursor = self.conn.execute(self._SQL_GET_SESSION, (user_id,))
+            result = cursor.fetchone()
+
+        # BLOB (старые записи могут быть TEXT) разбирается без промежуточной строки
+        loaded = loads(result[0]) if result else []
+
+        with self._mem_lock:
+            # Пока шло чтение, сессия могла появиться в памяти - она новее, чем в базе
+            history = self._mem.get(user_id)
+            if history is not None:
+                self._mem.move_to_end(user_id)
+            else:
+                history = self._evicted.get(user_id)
+                if history is not None:
+                    self._dirty.add(user_id)
+                else:
+                    history = loaded
+                self._store(user_id, history)
+
+        return list(history)
+
+    @staticmethod
+    def build_messages(history: List[Dict[str, str]], user_message: str) -> List[Dict[str, Any]]:
+        """Сборка сообщений запроса с пометкой кэшируемого префикса истории."""
+        messages: List[Dict[str, Any]] = list(history)
+        if messages:
+            # Точка кэша на последней зафиксированной реплике: весь префикс до нее
+            # (system + история) совпадает с префиксом предыдущего запроса
+            last = messages[-1]
+            messages[-1] = {
+                "role": last["role"],
+                "content": [{
+                    "type": "text",
+                    "text": last["content"],
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def _trim_history(self, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Ограничение истории по бюджету токенов."""
+        total = sum(_approx_tokens(message) for message in history)
+        if total <= self.max_tokens_history:
+            return history
+
+        # Удаляем самые старые пары реплик с запасом, до нижней границы: тогда начало
+        # истории (кэшируемый префикс) не меняется несколько следующих ходов.
+        # Последняя пара (вопрос и ответ) сохраняется всегда
+        low_water = self.max_tokens_history * self._TRIM_LOW_WATER
+        start = 0
+        while total > low_water and len(history) - start > 2:
+            total -= _approx_tokens(history[start]) + _approx_tokens(history[start + 1])
+            start += 2
+        return history[start:] if start else history
 
     def update_session(self, user_id: int, history: List[Dict[str, str]]) -> None:
         """Обновление истории диалога для пользователя."""
-        conn = sqlite3.connect(self.db.db_name)
-        cursor = conn.cursor()
-
-        # Ограничиваем историю для экономии токенов
-        # Оставляем последние N сообщений, чтобы не превысить лимит контекста
-        max_messages = 10  # Можно настроить в зависимости от потребностей
-        if len(history) > max_messages * 2:  # *2 потому что каждое сообщение - это пара реплик
-            history = history[-max_messages * 2:]
-
-        history_json = json.dumps(history)
-
-        cursor.execute(
-            "INSERT OR REPLACE INTO sessions (user_id, history, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
-            (user_id, history_json)
-        )
-
-        conn.commit()
-        conn.close()
+        history = list(self._trim_history(history))
+        with self._mem_lock:
+            self._dirty.add(user_id)
+            self._store(user_id, history)
+
+    def save_turn(
+        self, user_id: int, history: List[Dict[str, str]], user_message: str, bot_response: str
+    ) -> None:
+        """Сохранение истории вместе с логом реплики (запишутся при следующем сбросе)."""
+        history = list(self._trim_history(history))
+        with self._mem_lock:
+            self._dirty.add(user_id)
+            self._pending_logs.append((user_id, user_message, bot_response))
+            self._store(user_id, history)
 
     def clear_session(self, user_id: int) -> None:
         """Очистка истории диалога для пользователя."""
-        conn = sqlite3.connect(self.db.db_name)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "UPDATE sessions SET history = '[]', updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-            (user_id,)
-        )
-
-        conn.commit()
-        conn.close()
+        with self._mem_lock:
+            self._dirty.add(user_id)
+            self._store(user_id, [])
@@ -1,17 +1,30 @@
 # main.py - основной файл приложения
+import asyncio
 import os
 import logging
+import time
+from datetime import timedelta
+import aiohttp
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Message, Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from database import Database
-from app.api.claude_client import ClaudeClient
-from session_manager import SessionManager
+from app.api.claude_client import ClaudeClient, ClaudeAPIError, Database, SessionManager
 
 # Загрузка переменных окружения
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
+# Бюджет токенов на историю диалога, отправляемую с каждым запросом
+MAX_TOKENS_HISTORY = int(os.getenv("MAX_TOKENS_HISTORY", "6000"))
+
+# Системный промпт неизменен, чтобы префикс запроса попадал в кэш промптов Anthropic
+SYSTEM_PROMPT = "Ты - полезный ассистент. Отвечай на языке пользователя."
+
+# Параметры потоковой отправки ответа
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+STREAM_EDIT_MIN_CHARS = 80     # Сколько новых символов накопить перед правкой сообщения
+STREAM_EDIT_INTERVAL = 1.0     # Не чаще одной правки в секунду (лимиты Telegram)
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,7 +35,7 @@ logger = logging.getLogger(__name__)
 # Инициализация компонентов
 db = Database()
 claude_client = ClaudeClient(api_key=CLAUDE_API_KEY)
-session_manager = SessionManager(db)
+session_manager = SessionManager(db, max_tokens_history=MAX_TOKENS_HISTORY)
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -31,8 +44,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     username = update.effective_user.username
 
     # Регистрация пользователя в БД если он новый
-    if not db.user_exists(user_id):
-        db.register_user(user_id, username)
+    await asyncio.to_thread(db.register_user, user_id, username)
 
     await update.message.reply_text(
         "Привет! Я бот, который позволяет взаимодействовать с Claude API. "
@@ -55,14 +67,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Очистка истории диалога."""
     user_id = update.effective_user.id
-    session_manager.clear_session(user_id)
+    await asyncio.to_thread(session_manager.clear_session, user_id)
     await update.message.reply_text("История диалога очищена!")
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Настройки бота."""
     user_id = update.effective_user.id
-    settings = db.get_user_settings(user_id)
+    settings = await asyncio.to_thread(db.get_user_settings, user_id)
 
     settings_text = f"""
     Текущие настройки:
@@ -86,7 +98,7 @@ async def set_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     model = context.args[0]
-    db.update_user_setting(user_id, "model", model)
+    await asyncio.to_thread(db.update_user_setting, user_id, "model", model)
     await update.message.reply_text(f"Модель изменена на {model}.")
 
 
@@ -100,7 +112,7 @@ async def set_temp_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     try:
         temp = float(context.args[0])
         if 0.0 <= temp <= 1.0:
-            db.update_user_setting(user_id, "temperature", temp)
+            await asyncio.to_thread(db.update_user_setting, user_id, "temperature", temp)
             await update.message.reply_text(f"Temperature установлен на {temp}.")
         else:
             await update.message.reply_text("Temperature должен быть в диапазоне от 0.0 до 1.0.")
@@ -108,58 +120,141 @@ async def set_temp_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("Пожалуйста, укажите корректное числовое значение.")
 
 
+async def _edit_reply(message: Message, text: str) -> bool:
+    """Правка сообщения с ответом; сбой правки не прерывает обработку."""
+    try:
+        await message.edit_text(text)
+    except TelegramError as e:
+        logger.warning(f"Не удалось обновить сообщение: {e}")
+        return False
+    return True
+
+
+async def _finish_reply(update: Update, message: Message, text: str) -> None:
+    """Окончательная правка сообщения с ответом; при неудаче ответ отправляется заново."""
+    try:
+        await message.edit_text(text)
+        return
+    except RetryAfter as e:
+        # Превышен лимит правок - ждем, сколько просит Telegram, и пробуем еще раз
+        retry_after = e.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        await asyncio.sleep(retry_after)
+        if await _edit_reply(message, text):
+            return
+    except TelegramError as e:
+        logger.warning(f"Не удалось обновить сообщение: {e}")
+
+    await update.message.reply_text(text)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик входящих сообщений."""
     user_id = update.effective_user.id
     user_message = update.message.text
 
-    # Получаем настройки пользователя
-    settings = db.get_user_settings(user_id)
-
-    # Получаем историю диалога
-    history = session_manager.get_session(user_id)
-
-    # Добавляем сообщение пользователя в историю
-    history.append({"role": "user", "content": user_message})
+    # Настройки пользователя, история диалога (зафиксированные реплики, не меняются
+    # между запросами) и индикатор печати независимы - выполняем параллельно.
+    # Запросы к SQLite выполняем в пуле потоков, чтобы не блокировать цикл событий
+    settings, history, _ = await asyncio.gather(
+        asyncio.to_thread(db.get_user_settings, user_id),
+        asyncio.to_thread(session_manager.get_session, user_id),
+        update.message.chat.send_action(action="typing"),
+        return_exceptions=True
+    )
+    # Сбой индикатора печати не критичен, без настроек и истории продолжать нельзя
+    for result in (settings, history):
+        if isinstance(result, BaseException):
+            raise result
 
-    # Индикатор печати
-    await update.message.chat.send_action(action="typing")
+    # Запрос: стабильный префикс истории, помеченный для кэша, и новое сообщение
+    messages = session_manager.build_messages(history, user_message)
 
+    reply = None
     try:
-        # Отправляем запрос к Claude API
-        response = await claude_client.send_message(
-            messages=history,
+        # Сразу отправляем заглушку и дополняем ее по мере генерации ответа
+        reply = await update.message.reply_text("…")
+
+        chunks = []
+        length = 0
+        shown_length = 0
+        last_edit = time.monotonic()
+
+        # Отправляем потоковый запрос к Claude API
+        async for text in claude_client.send_message_stream(
+            messages=messages,
+            system=SYSTEM_PROMPT,
             model=settings.get("model", "claude-3-7-sonnet-20250219"),
             temperature=settings.get("temperature", 0.7),
             max_tokens=settings.get("max_tokens", 4000)
+        ):
+            chunks.append(text)
+            length += len(text)
+
+            # Редактируем сообщение, когда накопилось STREAM_EDIT_MIN_CHARS символов
+            # и с прошлой попытки прошло STREAM_EDIT_INTERVAL секунд
+            now = time.monotonic()
+            if (
+                shown_length < TELEGRAM_MESSAGE_LIMIT
+                and length - shown_length >= STREAM_EDIT_MIN_CHARS
+                and now - last_edit >= STREAM_EDIT_INTERVAL
+            ):
+                # Показанной считаем только успешно отправленную правку
+                if await _edit_reply(reply, "".join(chunks)[:TELEGRAM_MESSAGE_LIMIT]):
+                    shown_length = min(length, TELEGRAM_MESSAGE_LIMIT)
+                last_edit = now
+
+        # Полный ответ Claude
+        claude_response = "".join(chunks)
+        if not claude_response:
+            # Пустой ответ в истории сделал бы все следующие запросы некорректными
+            raise ClaudeAPIError("API error: empty response")
+
+        # Фиксируем реплики в истории: в следующем запросе они войдут в кэшируемый префикс
+        history.append({"role": "user", "content": user_message})
+        history.append({"role": "assistant", "content": claude_response})
+
+        # Сохраняем обновленную историю и логируем диалог (запись в базу - в фоне)
+        await asyncio.to_thread(
+            session_manager.save_turn, user_id, history, user_message, claude_response
         )
 
-        # Получаем ответ от Claude
-        claude_response = response["content"][0]["text"]
+        # Показываем ответ целиком; то, что не влезло в одно сообщение, отправляем отдельно
+        if shown_length < min(length, TELEGRAM_MESSAGE_LIMIT):
+            await _finish_reply(update, reply, claude_response[:TELEGRAM_MESSAGE_LIMIT])
+        for start in range(TELEGRAM_MESSAGE_LIMIT, len(claude_response), TELEGRAM_MESSAGE_LIMIT):
+            await update.message.reply_text(claude_response[start:start + TELEGRAM_MESSAGE_LIMIT])
 
-        # Добавляем ответ в историю
-        history.append({"role": "assistant", "content": claude_response})
+    except (aiohttp.ClientError, asyncio.TimeoutError, ClaudeAPIError, KeyError, IndexError) as e:
+        logger.error(f"Ошибка при обработке запроса: {e}")
+        error_text = "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз позже."
+        if reply is None or not await _edit_reply(reply, error_text):
+            await update.message.reply_text(error_text)
 
-        # Сохраняем обновленную историю
-        session_manager.update_session(user_id, history)
 
-        # Отправляем ответ пользователю
-        await update.message.reply_text(claude_response)
+async def post_init(application: Application) -> None:
+    """Запуск фоновых задач после инициализации бота."""
+    session_manager.start()
 
-        # Логируем диалог
-        db.log_conversation(user_id, user_message, claude_response)
 
-    excclaude_client.pyept Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
-        await update.message.reply_text(
-            "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз позже."
-        )
+async def post_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке бота."""
+    await claude_client.close()
+    await session_manager.close()
+    db.close()
 
 
 def main() -> None:
     """Запуск бота."""
     # Создание приложения
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start_command))
@@ -0,0 +1,28 @@
+# serialization.py - быстрая (де)сериализация JSON
+from typing import Any, Union
+
+try:
+    import orjson as _json
+except ImportError:  # pragma: no cover - orjson не установлен
+    _json = None
+    import json
+
+
+if _json is not None:
+    def dumps(obj: Any) -> bytes:
+        """Сериализация объекта в JSON (bytes)."""
+        return _json.dumps(obj)
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        """Десериализация JSON из bytes или str."""
+        return _json.loads(data)
+else:
+    def dumps(obj: Any) -> bytes:
+        """Сериализация объекта в JSON (bytes)."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        """Десериализация JSON из bytes или str."""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
@@ -0,0 +1,167 @@
+# test_bot.py - тесты обработчиков бота
+import importlib
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import RetryAfter, TelegramError
+
+from app.api.claude_client import ClaudeAPIError, Database, SessionManager
+
+
+class FakeMessage:
+    """Сообщение Telegram: запоминает ответы и правки."""
+
+    def __init__(self, text="", edit_failures=None):
+        self.text = text
+        self.edits = []
+        self.replies = []
+        # Исключения для очередных вызовов edit_text (None - правка проходит)
+        self.edit_failures = list(edit_failures or [])
+        self.reply_edit_failures = []
+        self.chat = SimpleNamespace(send_action=self._send_action)
+
+    async def _send_action(self, action):
+        pass
+
+    async def reply_text(self, text):
+        reply = FakeMessage(text, self.reply_edit_failures)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text):
+        if self.edit_failures:
+            error = self.edit_failures.pop(0)
+            if error is not None:
+                raise error
+        self.edits.append(text)
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # При импорте main создает базу в текущем каталоге
+    monkeypatch.chdir(tmp_path)
+    main = importlib.import_module("app.main")
+
+    db = Database(str(tmp_path / "test.db"))
+    monkeypatch.setattr(main, "db", db)
+    monkeypatch.setattr(main, "session_manager", SessionManager(db))
+
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(main, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    main.clock = clock
+    yield main
+    db.close()
+
+
+def stub_stream(main, monkeypatch, chunks, error=None):
+    """Подмена потокового ответа: chunks - пары (текст, сколько секунд прошло)."""
+    async def send_message_stream(**kwargs):
+        for text, elapsed in chunks:
+            main.clock.now += elapsed
+            yield text
+        if error is not None:
+            raise error
+
+    monkeypatch.setattr(main.claude_client, "send_message_stream", send_message_stream)
+
+
+def make_update(text="Привет"):
+    message = FakeMessage(text)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=message)
+    return update, message
+
+
+async def handle(main, update):
+    await main.handle_message(update, SimpleNamespace())
+
+
+@pytest.mark.asyncio
+async def test_edits_are_throttled_to_interval(main, monkeypatch):
+    stub_stream(main, monkeypatch, [(str(i) * 100, 0.5) for i in range(6)])
+    update, message = make_update()
+
+    await handle(main, update)
+
+    placeholder = message.replies[0]
+    full = "".join(str(i) * 100 for i in range(6))
+    # Правка раз в секунду: на 1.0, 2.0 и 3.0 с; последняя уже показывает весь ответ
+    assert [len(text) for text in placeholder.edits] == [200, 400, 600]
+    assert placeholder.edits[-1] == full
+    assert main.session_manager.get_session(1) == [
+        {"role": "user", "content": "Привет"},
+        {"role": "assistant", "content": full},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_failed_edit_does_not_skip_final_edit(main, monkeypatch):
+    stub_stream(main, monkeypatch, [("a" * 100, 1.0)])
+    update, message = make_update()
+    message.reply_edit_failures = [TelegramError("Timed out")]
+
+    await handle(main, update)
+
+    assert message.replies[0].edits == ["a" * 100]
+
+
+@pytest.mark.asyncio
+async def test_long_answer_is_split_by_telegram_limit(main, monkeypatch):
+    answer = "x" * 4096 + "y" * 1000
+    stub_stream(main, monkeypatch, [(answer, 0.0)])
+    update, message = make_update()
+
+    await handle(main, update)
+
+    placeholder, rest = message.replies
+    assert placeholder.edits == ["x" * 4096]
+    assert rest.text == "y" * 1000
+
+
+@pytest.mark.asyncio
+async def test_final_edit_retries_after_flood_limit(main, monkeypatch):
+    stub_stream(main, monkeypatch, [("ответ", 0.0)])
+    update, message = make_update()
+    message.reply_edit_failures = [RetryAfter(0)]
+
+    await handle(main, update)
+
+    assert message.replies[0].edits == ["ответ"]
+    assert len(message.replies) == 1
+
+
+@pytest.mark.asyncio
+async def test_final_edit_falls_back_to_new_message(main, monkeypatch):
+    stub_stream(main, monkeypatch, [("ответ", 0.0)])
+    update, message = make_update()
+    message.reply_edit_failures = [RetryAfter(0), RetryAfter(0)]
+
+    await handle(main, update)
+
+    assert message.replies[0].edits == []
+    assert message.replies[1].text == "ответ"
+
+
+@pytest.mark.asyncio
+async def test_empty_answer_is_not_saved(main, monkeypatch):
+    stub_stream(main, monkeypatch, [])
+    update, message = make_update()
+
+    await handle(main, update)
+
+    assert message.replies[0].edits[0].startswith("Произошла ошибка")
+    assert main.session_manager.get_session(1) == []
+    assert not main.session_manager._dirty
+    assert not main.session_manager._pending_logs
+
+
+@pytest.mark.asyncio
+async def test_stream_error_replaces_placeholder(main, monkeypatch):
+    stub_stream(main, monkeypatch, [("частичный", 0.0)], error=ClaudeAPIError("API error: broken"))
+    update, message = make_update()
+
+    await handle(main, update)
+
+    assert message.replies[0].edits == [
+        "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз позже."
+    ]
+    assert main.session_manager.get_session(1) == []
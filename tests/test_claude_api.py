@@ -0,0 +1,141 @@
+# test_claude_api.py - тесты клиента Claude API
+import json
+
+import pytest
+
+from app.api.claude_client import ClaudeAPIError, ClaudeClient
+
+
+class FakeContent:
+    """Тело ответа: построчная выдача, как у aiohttp.StreamReader."""
+
+    def __init__(self, lines):
+        self._lines = lines
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for line in self._lines:
+            yield line
+
+
+class FakeResponse:
+    def __init__(self, lines, status=200):
+        self.status = status
+        self.content = FakeContent(lines)
+
+    async def read(self):
+        return b"".join(self.content._lines)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    closed = False
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+        self.kwargs = []
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append(data)
+        self.kwargs.append(kwargs)
+        return self.response
+
+
+def data(event):
+    """Строка SSE с событием."""
+    return b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n"
+
+
+def text_delta(text):
+    return data({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}})
+
+
+def make_client(lines, status=200):
+    client = ClaudeClient(api_key="test")
+    client._session = FakeSession(FakeResponse(lines, status))
+    return client
+
+
+async def collect(client):
+    return [text async for text in client.send_message_stream(messages=[])]
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_text_deltas():
+    client = make_client([
+        b"event: message_start\n",
+        data({"type": "message_start", "message": {}}),
+        b"\n",
+        b"event: content_block_delta\n",
+        text_delta("При"),
+        data({"type": "content_block_delta", "index": 0, "delta": {"type": "input_json_delta", "partial_json": "{}"}}),
+        data({"type": "ping"}),
+        text_delta("вет"),
+        data({"type": "message_stop"}),
+        text_delta("!"),
+    ])
+
+    assert await collect(client) == ["При", "вет"]
+    assert b'"stream":true' in client._session.requests[0]
+
+
+@pytest.mark.asyncio
+async def test_stream_has_no_total_timeout():
+    client = make_client([data({"type": "message_stop"})])
+
+    await collect(client)
+
+    timeout = client._session.kwargs[0]["timeout"]
+    assert timeout.total is None
+    assert timeout.sock_read is not None
+
+
+@pytest.mark.asyncio
+async def test_stream_error_event_raises():
+    client = make_client([
+        text_delta("a"),
+        data({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}),
+    ])
+
+    with pytest.raises(ClaudeAPIError, match="overloaded_error"):
+        await collect(client)
+
+
+@pytest.mark.asyncio
+async def test_stream_without_message_stop_raises():
+    client = make_client([text_delta("a")])
+
+    with pytest.raises(ClaudeAPIError, match="message_stop"):
+        await collect(client)
+
+
+@pytest.mark.asyncio
+async def test_stream_http_error_raises():
+    client = make_client([b'{"type":"error"}'], status=529)
+
+    with pytest.raises(ClaudeAPIError, match="529"):
+        await collect(client)
+
+
+@pytest.mark.asyncio
+async def test_stream_malformed_event_raises_api_error():
+    client = make_client([text_delta("a"), b"data: {not json\n"])
+
+    with pytest.raises(ClaudeAPIError, match="invalid stream event"):
+        await collect(client)
+
+
+@pytest.mark.asyncio
+async def test_malformed_response_body_raises_api_error():
+    client = make_client([b"<html>Bad gateway</html>"])
+
+    with pytest.raises(ClaudeAPIError, match="invalid JSON"):
+        await client.send_message(messages=[])
@@ -0,0 +1,75 @@
+# test_database.py - тесты работы с базой данных
+import json
+import sqlite3
+
+from app.api.claude_client import Database
+
+
+def create_legacy_db(path):
+    """База в старой схеме: все настройки пользователя в JSON-колонке settings."""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        settings TEXT DEFAULT '{}'
+    )
+    ''')
+    conn.execute(
+        "INSERT INTO users (user_id, username, settings) VALUES (?, ?, ?)",
+        (1, "alice", json.dumps({
+            "model": "claude-3-5-haiku-20241022",
+            "temperature": 0.3,
+            "max_tokens": 2000,
+            "language": "ru"
+        }))
+    )
+    conn.execute("INSERT INTO users (user_id, username) VALUES (?, ?)", (2, "bob"))
+    conn.commit()
+    conn.close()
+
+
+def test_settings_migration_from_legacy_schema(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    create_legacy_db(path)
+
+    # Повторный запуск не должен ни ломать схему, ни повторно переносить данные
+    Database(path).close()
+    db = Database(path)
+
+    rows = db.conn.execute(
+        "SELECT user_id, model, temperature, max_tokens, settings FROM users ORDER BY user_id"
+    ).fetchall()
+    assert rows[0][:4] == (1, "claude-3-5-haiku-20241022", 0.3, 2000)
+    assert json.loads(rows[0][4]) == {"language": "ru"}
+    assert rows[1][:4] == (2, None, None, None)
+    assert json.loads(rows[1][4]) == {}
+
+    assert db.get_user_settings(1) == {
+        "model": "claude-3-5-haiku-20241022",
+        "temperature": 0.3,
+        "max_tokens": 2000,
+        "language": "ru"
+    }
+    assert db.get_user_settings(2) == {}
+    db.close()
+
+
+def test_settings_after_migration_are_writable(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    create_legacy_db(path)
+    db = Database(path)
+
+    db.update_user_setting(1, "temperature", 0.9)
+    db.update_user_setting(1, "language", "en")
+    db.close()
+
+    db = Database(path)
+    assert db.get_user_settings(1) == {
+        "model": "claude-3-5-haiku-20241022",
+        "temperature": 0.9,
+        "max_tokens": 2000,
+        "language": "en"
+    }
+    db.close()
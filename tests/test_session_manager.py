@@ -0,0 +1,107 @@
+# test_session_manager.py - тесты менеджера сессий
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.api.claude_client import Database, SessionManager
+
+
+def turn(text):
+    return [{"role": "user", "content": text}, {"role": "assistant", "content": text + "!"}]
+
+
+def stored_sessions(db):
+    return dict(db.conn.execute("SELECT user_id, history FROM sessions").fetchall())
+
+
+def logged_count(db):
+    return db.conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "bot.db"))
+    yield db
+    db.close()
+
+
+def test_evicted_dirty_session_is_kept_until_flush(db):
+    manager = SessionManager(db, max_cached_sessions=1)
+
+    manager.update_session(1, turn("a"))
+    manager.update_session(2, turn("b"))
+
+    # Сессия 1 вытеснена из памяти, но в базу еще не записана
+    assert 1 not in manager._mem
+    assert stored_sessions(db) == {}
+    assert manager.get_session(1) == turn("a")
+
+    manager.flush()
+    assert SessionManager(db).get_session(1) == turn("a")
+    assert SessionManager(db).get_session(2) == turn("b")
+
+
+def test_newer_version_replaces_evicted_one(db):
+    manager = SessionManager(db, max_cached_sessions=1)
+
+    manager.update_session(1, turn("old"))
+    manager.update_session(2, turn("b"))
+    manager.update_session(1, turn("new"))
+    manager.flush()
+
+    assert SessionManager(db).get_session(1) == turn("new")
+
+
+def test_failed_flush_restores_pending_changes(db, monkeypatch):
+    manager = SessionManager(db, max_cached_sessions=1)
+    manager.save_turn(1, turn("a"), "a", "a!")
+    manager.save_turn(2, turn("b"), "b", "b!")
+
+    def fail(sessions, logs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(db, "persist_turns", fail)
+    with pytest.raises(RuntimeError):
+        manager.flush()
+
+    assert manager._dirty == {2}
+    assert set(manager._evicted) == {1}
+    assert len(manager._pending_logs) == 2
+
+    monkeypatch.undo()
+    manager.flush()
+
+    assert set(stored_sessions(db)) == {1, 2}
+    assert logged_count(db) == 2
+    assert not manager._dirty and not manager._evicted and not manager._pending_logs
+
+
+@pytest.mark.asyncio
+async def test_close_waits_for_running_flush(db, monkeypatch):
+    manager = SessionManager(db, flush_interval=0.01)
+    flush_started = threading.Event()
+    serialize = SessionManager._serialize
+
+    def slow_serialize(history):
+        flush_started.set()
+        time.sleep(0.2)
+        return serialize(history)
+
+    monkeypatch.setattr(manager, "_serialize", slow_serialize)
+    manager.save_turn(1, turn("a"), "a", "a!")
+    manager.start()
+
+    # Останавливаемся, пока периодический сброс выполняется в потоке
+    await asyncio.to_thread(flush_started.wait, 1)
+    await manager.close()
+    db.close()
+
+    reopened = Database(db.db_name)
+    try:
+        assert set(stored_sessions(reopened)) == {1}
+        assert logged_count(reopened) == 1
+    finally:
+        reopened.close()
+    assert not manager._dirty and not manager._pending_logs